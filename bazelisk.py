@@ -16,28 +16,40 @@ limitations under the License.
 """
 
 from contextlib import closing
-from distutils.version import LooseVersion
+import hashlib
+import heapq
 import json
 import os
 import os.path
 import platform
 import re
-import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import zlib
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 try:
-    from urllib.request import urlopen
+    # orjson parses the GitHub releases payload several times faster than json.
+    from orjson import loads as json_loads
 except ImportError:
-    # Python 2.x compatibility hack.
-    from urllib2 import urlopen
+    from json import loads as json_loads
 
 ONE_HOUR = 1 * 60 * 60
 
 LATEST_PATTERN = re.compile(r"latest(-(?P<offset>\d+))?$")
 
+VERSION_PATTERN = re.compile(r"(\d+\.\d+(?:\.\d+)?)(rc\d+)?")
+
+# GitHub always serializes "prerelease" after "tag_name" within each release.
+RELEASE_FIELDS_PATTERN = re.compile(
+    br'"tag_name":\s*"([^"\\]+)".*?"prerelease":\s*(true|false)', re.DOTALL
+)
+
 LAST_GREEN_COMMIT_BASE_PATH = (
     "https://storage.googleapis.com/bazel-untrusted-builds/last_green_commit/"
 )
@@ -59,6 +71,19 @@ BAZEL_REAL = "BAZEL_REAL"
 
 BAZEL_UPSTREAM = "bazelbuild"
 
+# Maps directories to the workspace root that find_workspace_root() found for them.
+WORKSPACE_ROOT_CACHE = {}
+
+# Bazel binaries are tens of MB, so copy them in large chunks.
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+# Querying the platform can be surprisingly slow, and the answer never changes.
+OPERATING_SYSTEM = platform.system().lower()
+
+MACHINE_ARCH_NAME = platform.machine().lower()
+if MACHINE_ARCH_NAME == "amd64":
+    MACHINE_ARCH_NAME = "x86_64"
+
 
 def decide_which_bazel_version_to_use():
     # Check in this order:
@@ -71,15 +96,18 @@ def decide_which_bazel_version_to_use():
     # - workspace_root/.bazelversion exists -> read contents, that version.
     # - workspace_root/WORKSPACE contains a version -> that version. (TODO)
     # - fallback: latest release
-    if "USE_BAZEL_VERSION" in os.environ:
-        return os.environ["USE_BAZEL_VERSION"]
+    version = os.environ.get("USE_BAZEL_VERSION")
+    if version is not None:
+        return version
 
     workspace_root = find_workspace_root()
     if workspace_root:
         bazelversion_path = os.path.join(workspace_root, ".bazelversion")
-        if os.path.exists(bazelversion_path):
+        try:
             with open(bazelversion_path, "r") as f:
                 return f.read().strip()
+        except FileNotFoundError:
+            pass
 
     return "latest"
 
@@ -87,10 +115,31 @@ def decide_which_bazel_version_to_use():
 def find_workspace_root(root=None):
     if root is None:
         root = os.getcwd()
-    if os.path.exists(os.path.join(root, "WORKSPACE")):
-        return root
-    new_root = os.path.dirname(root)
-    return find_workspace_root(new_root) if new_root != root else None
+    # Both the version selection and the tools/bazel delegation need the root.
+    if root not in WORKSPACE_ROOT_CACHE:
+        WORKSPACE_ROOT_CACHE[root] = search_workspace_root(root)
+    return WORKSPACE_ROOT_CACHE[root]
+
+
+def search_workspace_root(root):
+    while True:
+        if has_workspace_file(root):
+            return root
+        parent = os.path.dirname(root)
+        if parent == root:
+            return None
+        root = parent
+
+
+def has_workspace_file(directory):
+    # directory is always absolute and normalized, so there's no need for
+    # os.path.join. Like os.path.exists(), stat() follows symlinks, so a dangling
+    # WORKSPACE symlink doesn't mark a workspace root.
+    try:
+        os.stat(directory + os.sep + "WORKSPACE")
+        return True
+    except OSError:
+        return False
 
 
 def resolve_version_label_to_number_or_commit(bazelisk_directory, version):
@@ -120,8 +169,8 @@ def resolve_version_label_to_number_or_commit(bazelisk_directory, version):
                 "integer.".format(version)
             )
 
-        history = get_version_history(bazelisk_directory)
         offset = int(match.group("offset") or "0")
+        history = get_version_history(bazelisk_directory, limit=offset + 1)
         return resolve_latest_version(history, offset), False
 
     return version, False
@@ -134,43 +183,213 @@ def get_last_green_commit(path_suffix):
 def get_releases_json(bazelisk_directory):
     """Returns the most recent versions of Bazel, in descending order."""
     releases = os.path.join(bazelisk_directory, "releases.json")
+    etag_path = releases + ".etag"
 
     # Use a cached version if it's fresh enough.
-    if os.path.exists(releases):
-        if abs(time.time() - os.path.getmtime(releases)) < ONE_HOUR:
-            with open(releases, "rb") as f:
-                try:
-                    return json.loads(f.read().decode("utf-8"))
-                except ValueError:
-                    print("WARN: Could not parse cached releases.json.")
-                    pass
+    releases_mtime = get_mtime(releases)
+    if is_fresh(releases_mtime):
+        with open(releases, "rb") as f:
+            try:
+                return json_loads(f.read())
+            except ValueError:
+                print("WARN: Could not parse cached releases.json.")
+                pass
+
+    # Ask GitHub to only send the releases if they changed since we cached them.
+    headers = {"Accept": "application/vnd.github+json"}
+    if releases_mtime is not None and os.path.exists(etag_path):
+        with open(etag_path, "r") as f:
+            headers["If-None-Match"] = f.read().strip()
+
+    url = "https://api.github.com/repos/bazelbuild/bazel/releases"
+    try:
+        body, response_headers = read_remote_file(url, headers)
+    except HTTPError as e:
+        if e.code != 304:
+            raise
+        cache_is_valid = True
+        with open(releases, "rb") as f:
+            try:
+                releases_json = json_loads(f.read())
+            except ValueError:
+                sys.stderr.write("WARN: Could not parse cached releases.json.\n")
+                cache_is_valid = False
+        if cache_is_valid:
+            # The cached version is still up to date, so it's fresh for another hour.
+            os.utime(releases, None)
+            return releases_json
+        # The ETag belongs to the corrupted file, so fetch the releases again.
+        del headers["If-None-Match"]
+        body, response_headers = read_remote_file(url, headers)
+
+    releases_json = parse_releases_json(body)
+    # Other Bazelisk processes may read releases.json at the same time.
+    write_file_atomically(releases, json.dumps(releases_json).encode("utf-8"))
+
+    etag = response_headers.get("ETag")
+    if etag:
+        write_file_atomically(etag_path, etag.encode("utf-8"))
+    elif os.path.exists(etag_path):
+        os.remove(etag_path)
+
+    return releases_json
+
+
+def parse_releases_json(body):
+    """Extracts tag_name and prerelease of every release from the GitHub API response.
+
+    Scanning for these two fields is much cheaper than building dicts for all
+    fields of all releases. If the response doesn't have the expected shape, it
+    is parsed as regular JSON instead.
+    """
+    releases_json = [
+        {"tag_name": match.group(1).decode("utf-8"), "prerelease": match.group(2) == b"true"}
+        for match in RELEASE_FIELDS_PATTERN.finditer(body)
+    ]
+    # No matches at all may just as well mean that the response isn't a list of
+    # releases, so only the JSON parser can tell.
+    if releases_json and len(releases_json) == body.count(b'"tag_name":'):
+        return releases_json
+    releases_json = json_loads(body)
+    if not isinstance(releases_json, list):
+        raise Exception("Unexpected response from the GitHub releases API: expected a list.")
+    return slim_releases_json(releases_json)
+
+
+def slim_releases_json(releases_json):
+    """Drops all fields of the GitHub releases that Bazelisk does not use.
+
+    This keeps releases.json small, which makes reading it again cheap.
+    """
+    return [
+        {"tag_name": release["tag_name"], "prerelease": release["prerelease"]}
+        for release in releases_json
+    ]
 
-    with open(releases, "wb") as f:
-        body = read_remote_text_file("https://api.github.com/repos/bazelbuild/bazel/releases")
-        f.write(body.encode("utf-8"))
-        return json.loads(body)
 
+def get_mtime(path):
+    """Returns the modification time of the given file, or None if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
 
-def read_remote_text_file(url):
-    with closing(urlopen(url)) as res:
+
+def is_fresh(mtime):
+    """Returns whether a cache file with the given modification time (or None if
+    it doesn't exist) was written less than an hour ago.
+
+    Files with a modification time in the future are considered stale.
+    """
+    return mtime is not None and 0 <= time.time() - mtime < ONE_HOUR
+
+
+def write_file_atomically(path, data):
+    """Writes the given bytes to path, so that readers never see a partial file."""
+    temp_path = "{}.{}.tmp".format(path, os.urandom(8).hex())
+    # Unlike tempfile, which only lets the owner read its files, this lets the
+    # umask decide, so the caches work in a BAZELISK_HOME shared with other users.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    fd = os.open(temp_path, flags, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_remote_file(url, headers=None):
+    """Returns the body and the headers of the response for the given URL.
+
+    The response is transferred gzip-compressed if the server supports it.
+    """
+    request = Request(url, headers=headers or {})
+    request.add_header("Accept-Encoding", "gzip")
+    with closing(urlopen(request)) as res:
         body = res.read()
-        try:
-            return body.decode(res.info().get_content_charset("iso-8859-1"))
-        except AttributeError:
-            # Python 2.x compatibility hack
-            return body.decode(res.info().getparam("charset") or "iso-8859-1")
+        response_headers = res.info()
+    if response_headers.get("Content-Encoding") == "gzip":
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return body, response_headers
+
+
+def read_remote_text_file(url):
+    body, response_headers = read_remote_file(url)
+    return body.decode(response_headers.get_content_charset("iso-8859-1"))
+
+
+def get_version_history(bazelisk_directory, limit=None):
+    """Returns the released versions of Bazel, in descending order.
+
+    Args:
+        bazelisk_directory: string; path to a directory that can store
+            temporary data for Bazelisk.
+        limit: int; if set, only the `limit` most recent versions are returned.
+    Returns:
+        A list of version strings.
+    """
+    releases = os.path.join(bazelisk_directory, "releases.json")
+    history_cache = os.path.join(bazelisk_directory, "releases_history.json")
+
+    # Sorting the releases is only necessary when releases.json has changed.
+    history = read_cached_version_history(history_cache, releases, limit)
+    if history is not None:
+        return history
+
+    history = order_releases(get_releases_json(bazelisk_directory), limit)
+
+    cached = {
+        "releases_mtime": os.path.getmtime(releases),
+        "complete": limit is None or len(history) < limit,
+        "history": history,
+    }
+    write_file_atomically(history_cache, json.dumps(cached).encode("utf-8"))
+    return history
+
 
+def order_releases(releases_json, limit=None):
+    """Returns the versions of all non-prerelease releases, in descending order."""
+    versions = (release["tag_name"] for release in releases_json if not release["prerelease"])
+    if limit is None:
+        return sorted(versions, key=version_sort_key, reverse=True)
+    # Selecting the top entries is linear for small limits such as "latest".
+    return heapq.nlargest(limit, versions, key=version_sort_key)
 
-def get_version_history(bazelisk_directory):
-    ordered = sorted(
-        (
-            LooseVersion(release["tag_name"])
-            for release in get_releases_json(bazelisk_directory)
-            if not release["prerelease"]
-        ),
-        reverse=True,
-    )
-    return [str(v) for v in ordered]
+
+def version_sort_key(version):
+    """Returns a key that orders release versions such as "0.19.1" numerically."""
+    return tuple(int(part) for part in version.split(".") if part.isdigit())
+
+
+def read_cached_version_history(history_cache, releases, limit):
+    """Returns the cached version history if it was derived from a fresh releases.json
+    and contains at least `limit` versions (or all of them if `limit` is None)."""
+    releases_mtime = get_mtime(releases)
+    if not is_fresh(releases_mtime):
+        return None
+
+    try:
+        with open(history_cache, "rb") as f:
+            cached = json_loads(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        sys.stderr.write("WARN: Could not parse cached releases_history.json.\n")
+        return None
+
+    if not isinstance(cached, dict) or cached.get("releases_mtime") != releases_mtime:
+        return None
+
+    history = cached.get("history")
+    if history is None:
+        return None
+    if cached.get("complete"):
+        return history[:limit]
+    if limit is None or len(history) < limit:
+        return None
+    return history[:limit]
 
 
 def resolve_latest_version(version_history, offset):
@@ -186,13 +405,12 @@ def resolve_latest_version(version_history, offset):
 
 
 def get_operating_system():
-    operating_system = platform.system().lower()
-    if operating_system not in ("linux", "darwin", "windows"):
+    if OPERATING_SYSTEM not in ("linux", "darwin", "windows"):
         raise Exception(
             'Unsupported operating system "{}". '
-            "Bazel currently only supports Linux, macOS and Windows.".format(operating_system)
+            "Bazel currently only supports Linux, macOS and Windows.".format(OPERATING_SYSTEM)
         )
-    return operating_system
+    return OPERATING_SYSTEM
 
 
 def determine_executable_filename_suffix():
@@ -216,23 +434,25 @@ def determine_bazel_filename(version):
 
 
 def normalized_machine_arch_name():
-    machine = platform.machine().lower()
-    if machine == "amd64":
-        machine = "x86_64"
-    return machine
+    return MACHINE_ARCH_NAME
 
 
 def determine_url(version, is_commit, bazel_filename):
     if is_commit:
-        sys.stderr.write("Using unreleased version at commit {}\n".format(version))
         # No need to validate the platform thanks to determine_bazel_filename().
         return BAZEL_GCS_PATH_PATTERN.format(
-            platform=SUPPORTED_PLATFORMS[platform.system().lower()], commit=version
+            platform=SUPPORTED_PLATFORMS[OPERATING_SYSTEM], commit=version
         )
 
     # Split version into base version and optional additional identifier.
     # Example: '0.19.1' -> ('0.19.1', None), '0.20.0rc1' -> ('0.20.0', 'rc1')
-    (version, rc) = re.match(r"(\d*\.\d*(?:\.\d*)?)(rc\d+)?", version).groups()
+    match = VERSION_PATTERN.match(version)
+    if not match:
+        raise Exception(
+            'Invalid version "{}". Bazel release versions look like "0.20.0" or '
+            '"0.20.0rc1".'.format(version)
+        )
+    (version, rc) = match.groups()
 
     if "BAZELISK_BASE_URL" in os.environ:
         return "{}/{}/{}".format(
@@ -251,29 +471,112 @@ def trim_suffix(string, suffix):
         return string
 
 
-def download_bazel_into_directory(version, is_commit, directory):
-    bazel_filename = determine_bazel_filename(version)
-    url = determine_url(version, is_commit, bazel_filename)
+def download_bazel_into_directory(version, is_commit, directory, cancel=None):
+    if is_commit:
+        sys.stderr.write("Using unreleased version at commit {}\n".format(version))
 
+    bazel_filename = determine_bazel_filename(version)
     filename_suffix = determine_executable_filename_suffix()
     bazel_directory_name = trim_suffix(bazel_filename, filename_suffix)
     destination_dir = os.path.join(directory, bazel_directory_name, "bin")
-    maybe_makedirs(destination_dir)
 
     destination_path = os.path.join(destination_dir, "bazel" + filename_suffix)
     if not os.path.exists(destination_path):
+        # Everything below is only needed when the binary isn't cached yet.
+        url = determine_url(version, is_commit, bazel_filename)
+        maybe_makedirs(destination_dir)
         sys.stderr.write("Downloading {}...\n".format(url))
-        with tempfile.NamedTemporaryFile(prefix="bazelisk", dir=destination_dir, delete=False) as t:
-            with closing(urlopen(url)) as response:
-                shutil.copyfileobj(response, t)
-            t.flush()
-            os.fsync(t.fileno())
-        os.rename(t.name, destination_path)
-        os.chmod(destination_path, 0o755)
+        # Fetch the tiny checksum file while the binary is being downloaded.
+        wait_for_sha256 = None if is_commit else run_in_background(get_release_sha256, url)
+        t = tempfile.NamedTemporaryFile(prefix="bazelisk", dir=destination_dir, delete=False)
+        try:
+            with t:
+                with closing(urlopen(url)) as response:
+                    content_length = response.info().get("Content-Length")
+                    preallocate(t, content_length)
+                    sha256 = copy_and_hash(response, t, cancel)
+                # Reading from a connection that closed early just returns no more
+                # data, and the preallocated file already has the full size.
+                if content_length and t.tell() != int(content_length):
+                    raise Exception(
+                        "Incomplete download of {}: expected {} bytes, but got {}.".format(
+                            url, content_length, t.tell()
+                        )
+                    )
+                t.flush()
+                # Waiting for the data to reach the disk is slow, so it's opt-in. A
+                # binary truncated by a power loss isn't detected later on; users
+                # have to delete it (see README.md).
+                if os.environ.get("BAZELISK_FSYNC") == "1":
+                    os.fsync(t.fileno())
+            if wait_for_sha256:
+                expected_sha256 = wait_for_sha256()
+                if expected_sha256 and expected_sha256 != sha256:
+                    raise Exception(
+                        "SHA-256 checksum mismatch for {}: expected {}, but got {}.".format(
+                            url, expected_sha256, sha256
+                        )
+                    )
+            # Make the binary executable before it becomes visible under its final
+            # name, so that concurrent Bazelisk processes never find it without
+            # the executable bit.
+            os.chmod(t.name, 0o755)
+            os.rename(t.name, destination_path)
+        except BaseException:
+            # Don't leave partial downloads behind, e.g. after network errors or Ctrl-C.
+            os.remove(t.name)
+            raise
 
     return destination_path
 
 
+def copy_and_hash(src, dst, cancel=None):
+    """Copies src to dst and returns the SHA-256 hex digest of the copied data.
+
+    If the optional threading.Event cancel is set, the copy is aborted with an
+    exception before the next chunk.
+    """
+    sha256 = hashlib.sha256()
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise Exception("Download cancelled.")
+        chunk = src.read(DOWNLOAD_BUFFER_SIZE)
+        if not chunk:
+            return sha256.hexdigest()
+        dst.write(chunk)
+        sha256.update(chunk)
+
+
+def get_release_sha256(url):
+    """Returns the published SHA-256 checksum of the release binary at the given URL."""
+    try:
+        checksum_file = read_remote_text_file(url + ".sha256")
+    except OSError as e:
+        # Mirrors set up via BAZELISK_BASE_URL don't necessarily serve checksum
+        # files, and may answer with any kind of error for them.
+        not_found = isinstance(e, HTTPError) and e.code == 404
+        if not not_found and "BAZELISK_BASE_URL" not in os.environ:
+            raise
+        sys.stderr.write(
+            "WARN: Could not fetch {}.sha256 ({}), skipping verification.\n".format(url, e)
+        )
+        return None
+    # The file has the same format as the output of sha256sum.
+    parts = checksum_file.split()
+    return parts[0].lower() if parts else None
+
+
+def preallocate(f, content_length):
+    """Reserves space for the whole download up front to avoid fragmentation."""
+    if not content_length or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, int(content_length))
+    except (OSError, ValueError):
+        # Not every file system supports this, and it's only an optimization.
+        pass
+
+
 def get_bazelisk_directory():
     bazelisk_home = os.environ.get("BAZELISK_HOME")
     if bazelisk_home is not None:
@@ -309,11 +612,7 @@ def maybe_makedirs(path):
     """
   Creates a directory and its parents if necessary.
   """
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if not os.path.isdir(path):
-            raise e
+    os.makedirs(path, exist_ok=True)
 
 
 def delegate_tools_bazel(bazel_path):
@@ -325,13 +624,8 @@ def delegate_tools_bazel(bazel_path):
     if root:
         wrapper = os.path.join(root, TOOLS_BAZEL_PATH)
         if os.path.exists(wrapper) and os.access(wrapper, os.X_OK):
-            try:
-                if not os.path.samefile(wrapper, __file__):
-                    return wrapper
-            except AttributeError:
-                # Python 2 on Windows does not support os.path.samefile
-                if os.path.abspath(wrapper) != os.path.abspath(__file__):
-                    return wrapper
+            if not os.path.samefile(wrapper, __file__):
+                return wrapper
     return None
 
 
@@ -365,8 +659,16 @@ def make_bazel_cmd(bazel_path, argv):
 def execute_bazel(bazel_path, argv):
     cmd = make_bazel_cmd(bazel_path, argv)
 
-    # We cannot use close_fds on Windows, so disable it there.
-    p = subprocess.Popen([cmd['exec']] + cmd['args'], close_fds=os.name != "nt", env=cmd['env'])
+    if os.name != "nt":
+        # Replace this process with Bazel, so that the Python interpreter doesn't
+        # stay around for the whole build. Signals then go to Bazel directly.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execve(cmd['exec'], [cmd['exec']] + cmd['args'], cmd['env'])
+
+    # Windows doesn't support replacing the current process, so run Bazel as a
+    # child process instead. We cannot use close_fds on Windows, so disable it.
+    p = subprocess.Popen([cmd['exec']] + cmd['args'], close_fds=False, env=cmd['env'])
     while True:
         try:
             return p.wait()
@@ -378,16 +680,110 @@ def execute_bazel(bazel_path, argv):
 
 def get_bazel_path():
     bazelisk_directory = get_bazelisk_directory()
-    maybe_makedirs(bazelisk_directory)
+    # TODO: Support other forks just like Go version
+    bazel_directory = os.path.join(bazelisk_directory, "downloads", BAZEL_UPSTREAM)
+    # This also creates bazelisk_directory.
+    maybe_makedirs(bazel_directory)
 
     bazel_version = decide_which_bazel_version_to_use()
-    bazel_version, is_commit = resolve_version_label_to_number_or_commit(
-        bazelisk_directory, bazel_version
-    )
 
-    # TODO: Support other forks just like Go version
-    bazel_directory = os.path.join(bazelisk_directory, "downloads", BAZEL_UPSTREAM)
-    return download_bazel_into_directory(bazel_version, is_commit, bazel_directory)
+    prefetch = prefetch_stale_latest_version(bazelisk_directory, bazel_version, bazel_directory)
+    try:
+        bazel_version, is_commit = resolve_version_label_to_number_or_commit(
+            bazelisk_directory, bazel_version
+        )
+
+        if prefetch:
+            prefetched_version, cancel_prefetch, wait_for_prefetch = prefetch
+            if prefetched_version != bazel_version:
+                # Don't keep downloading a binary that isn't needed.
+                cancel_prefetch.set()
+            # If the guess was right, the download below will find the binary.
+            wait_for_prefetch()
+
+        return download_bazel_into_directory(bazel_version, is_commit, bazel_directory)
+    finally:
+        if prefetch:
+            # The prefetch runs in a daemon thread, which would be killed without
+            # removing its partial download if we exited on an error or Ctrl-C.
+            _, cancel_prefetch, wait_for_prefetch = prefetch
+            cancel_prefetch.set()
+            wait_for_prefetch()
+
+
+def prefetch_stale_latest_version(bazelisk_directory, version, bazel_directory):
+    """Starts downloading the Bazel release that a "latest" or "latest-N" label
+    resolved to in the stale releases.json, while the releases are being refreshed.
+
+    Most of the time no new Bazel release has been published since the last
+    refresh, so this overlaps the binary download with the GitHub API request.
+
+    Returns:
+        A (string, threading.Event, function) tuple with the prefetched version,
+        an event that cancels its download and a function that waits for the
+        download to finish, or None if nothing is being prefetched.
+    """
+    match = LATEST_PATTERN.match(version)
+    if not match:
+        return None
+
+    releases = os.path.join(bazelisk_directory, "releases.json")
+    try:
+        # A fresh releases.json resolves the label without any network access.
+        releases_mtime = get_mtime(releases)
+        if releases_mtime is None or is_fresh(releases_mtime):
+            return None
+
+        with open(releases, "rb") as f:
+            stale_releases = json_loads(f.read())
+
+        offset = int(match.group("offset") or "0")
+        history = order_releases(stale_releases, offset + 1)
+    except Exception:
+        # This is only an optimization, so leave any problems with the stale
+        # file to the regular refresh.
+        return None
+    if offset >= len(history):
+        return None
+    prefetched_version = history[offset]
+
+    cancel = threading.Event()
+
+    def download():
+        try:
+            download_bazel_into_directory(prefetched_version, False, bazel_directory, cancel)
+        except Exception:
+            # The guess may be wrong anyway; the regular download reports errors.
+            pass
+
+    return prefetched_version, cancel, run_in_background(download)
+
+
+def run_in_background(func, *args):
+    """Calls func(*args) in a separate thread.
+
+    Returns:
+        A function that waits for the call to finish and returns its result, or
+        raises the exception that it raised.
+    """
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = func(*args)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def wait():
+        thread.join()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
+
+    return wait
 
 
 def main(argv=None):
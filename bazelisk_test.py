@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Copyright 2018 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+
+import bazelisk
+
+VERSION = "5.0.0"
+BINARY = b"#!/bin/sh\necho bazel\n"
+RELEASES_FOR_TESTS = os.path.join(os.path.dirname(__file__), "releases_for_tests.json")
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    # All requested paths, in order.
+    requests = []
+    # Paths that are answered with 403 Forbidden, like some mirrors do for
+    # missing files.
+    forbidden = set()
+    # Paths whose responses stall after the first few bytes until resume is set.
+    stalled = set()
+    resume = threading.Event()
+    # Paths whose responses end before the announced Content-Length.
+    truncated = set()
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path in self.forbidden:
+            self.send_error(403)
+        elif self.path in self.stalled:
+            with open(self.translate_path(self.path), "rb") as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:4])
+            self.wfile.flush()
+            self.resume.wait(10)
+            self.wfile.write(data[4:])
+        elif self.path in self.truncated:
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"partial")
+        else:
+            super().do_GET()
+
+    def translate_path(self, path):
+        # Serves SERVER_ROOT, like the directory argument that needs Python 3.7.
+        return os.path.join(SERVER_ROOT, *path.lstrip("/").split("/"))
+
+    def log_message(self, *args):
+        pass
+
+
+def setUpModule():
+    """Serves fake Bazel releases from a local directory via BAZELISK_BASE_URL."""
+    global SERVER, SERVER_ROOT
+    SERVER_ROOT = tempfile.mkdtemp()
+    SERVER = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=SERVER.serve_forever, daemon=True).start()
+    os.environ["BAZELISK_BASE_URL"] = "http://127.0.0.1:{}".format(SERVER.server_port)
+
+
+def tearDownModule():
+    del os.environ["BAZELISK_BASE_URL"]
+    SERVER.shutdown()
+    SERVER.server_close()
+    shutil.rmtree(SERVER_ROOT)
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        del Handler.requests[:]
+        self.addCleanup(Handler.forbidden.clear)
+        self.addCleanup(Handler.stalled.clear)
+        self.addCleanup(Handler.resume.clear)
+        self.addCleanup(Handler.truncated.clear)
+
+    def publish(self, version, name, data):
+        """Makes data available as <BAZELISK_BASE_URL>/<version>/<name>."""
+        os.makedirs(os.path.join(SERVER_ROOT, version), exist_ok=True)
+        path = os.path.join(SERVER_ROOT, version, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.addCleanup(os.remove, path)
+
+    def list_downloaded_files(self):
+        return [
+            os.path.join(root, f) for root, _, files in os.walk(self.directory) for f in files
+        ]
+
+
+class DownloadTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.filename = bazelisk.determine_bazel_filename(VERSION)
+        self.url = "{}/{}/{}".format(os.environ["BAZELISK_BASE_URL"], VERSION, self.filename)
+        self.publish(VERSION, self.filename, BINARY)
+
+    def download(self, cancel=None):
+        return bazelisk.download_bazel_into_directory(VERSION, False, self.directory, cancel)
+
+    def test_download(self):
+        path = self.download()
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), BINARY)
+        self.assertTrue(os.access(path, os.X_OK))
+        self.assertEqual(self.list_downloaded_files(), [path])
+
+    def test_checksum_is_verified(self):
+        sha256 = hashlib.sha256(BINARY).hexdigest()
+        # Published checksum files have the same format as the output of sha256sum.
+        self.publish(
+            VERSION,
+            self.filename + ".sha256", "{}  {}\n".format(sha256.upper(), self.filename).encode()
+        )
+        self.assertEqual(bazelisk.get_release_sha256(self.url), sha256)
+        self.download()
+
+    def test_checksum_mismatch_leaves_no_files(self):
+        sha256 = hashlib.sha256(b"something else").hexdigest()
+        self.publish(VERSION, self.filename + ".sha256", sha256.encode())
+        with self.assertRaisesRegex(Exception, "checksum mismatch"):
+            self.download()
+        self.assertEqual(self.list_downloaded_files(), [])
+
+    def test_missing_checksum_skips_verification(self):
+        self.assertIsNone(bazelisk.get_release_sha256(self.url))
+
+    def test_checksum_error_on_mirror_skips_verification(self):
+        Handler.forbidden.add("/{}/{}.sha256".format(VERSION, self.filename))
+        self.assertIsNone(bazelisk.get_release_sha256(self.url))
+        self.download()
+
+    def test_checksum_error_on_release_server_fails(self):
+        Handler.forbidden.add("/{}/{}.sha256".format(VERSION, self.filename))
+        with mock.patch.dict(os.environ):
+            del os.environ["BAZELISK_BASE_URL"]
+            with self.assertRaises(HTTPError):
+                bazelisk.get_release_sha256(self.url)
+
+    def test_truncated_download_leaves_no_files(self):
+        Handler.truncated.add("/{}/{}".format(VERSION, self.filename))
+        with self.assertRaisesRegex(Exception, "Incomplete download"):
+            self.download()
+        self.assertEqual(self.list_downloaded_files(), [])
+
+    def test_cancelled_download_leaves_no_files(self):
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaisesRegex(Exception, "cancelled"):
+            self.download(cancel)
+        self.assertEqual(self.list_downloaded_files(), [])
+
+
+class GetBazelPathTest(ServerTestCase):
+    STALE_VERSION = "5.0.0"
+    NEW_VERSION = "5.1.0"
+
+    def setUp(self):
+        super().setUp()
+        for version in [self.STALE_VERSION, self.NEW_VERSION]:
+            self.publish(version, bazelisk.determine_bazel_filename(version), BINARY)
+        env = {"BAZELISK_HOME": self.directory, "USE_BAZEL_VERSION": "latest"}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_stale_releases(self, releases_json):
+        releases = os.path.join(self.directory, "releases.json")
+        with open(releases, "w") as f:
+            json.dump(releases_json, f)
+        os.utime(releases, (0, 0))
+
+    def get_bazel_path(self, latest_version):
+        """Calls get_bazel_path while GitHub lists latest_version as the latest release."""
+        body = json.dumps([{"tag_name": latest_version, "prerelease": False}]).encode()
+        read_remote_file = bazelisk.read_remote_file
+        run_in_background = bazelisk.run_in_background
+
+        def read_releases(url, headers=None):
+            if url.startswith("https://api.github.com/"):
+                return body, {}
+            return read_remote_file(url, headers)
+
+        def run_and_resume_stalled_downloads(func, *args):
+            wait = run_in_background(func, *args)
+
+            def resume_and_wait():
+                # Only resumed now that get_bazel_path decided whether to cancel.
+                Handler.resume.set()
+                return wait()
+
+            return resume_and_wait
+
+        with mock.patch.object(bazelisk, "read_remote_file", read_releases), mock.patch.object(
+            bazelisk, "run_in_background", run_and_resume_stalled_downloads
+        ), mock.patch.object(bazelisk, "DOWNLOAD_BUFFER_SIZE", 4):
+            return bazelisk.get_bazel_path()
+
+    def binary_path(self, version):
+        return "/{}/{}".format(version, bazelisk.determine_bazel_filename(version))
+
+    def test_prefetched_binary_is_reused(self):
+        self.write_stale_releases([{"tag_name": self.STALE_VERSION, "prerelease": False}])
+        path = self.get_bazel_path(self.STALE_VERSION)
+        self.assertIn(self.STALE_VERSION, path)
+        self.assertEqual(Handler.requests.count(self.binary_path(self.STALE_VERSION)), 1)
+        self.assertEqual(self.list_downloaded_files().count(path), 1)
+
+    def test_wrong_prefetch_is_cancelled(self):
+        self.write_stale_releases([{"tag_name": self.STALE_VERSION, "prerelease": False}])
+        Handler.stalled.add(self.binary_path(self.STALE_VERSION))
+        path = self.get_bazel_path(self.NEW_VERSION)
+        self.assertIn(self.NEW_VERSION, path)
+        self.assertIn(self.binary_path(self.STALE_VERSION), Handler.requests)
+        downloads = [f for f in self.list_downloaded_files() if "downloads" in f]
+        self.assertEqual(downloads, [path])
+
+    def test_broken_stale_releases_are_ignored(self):
+        self.write_stale_releases([{"tag_name": self.STALE_VERSION}])
+        path = self.get_bazel_path(self.NEW_VERSION)
+        self.assertIn(self.NEW_VERSION, path)
+        self.assertNotIn(self.binary_path(self.STALE_VERSION), Handler.requests)
+
+
+class DetermineUrlTest(unittest.TestCase):
+    def test_base_url_changes_are_respected(self):
+        for base_url in ["https://mirror-a.example", "https://mirror-b.example"]:
+            with mock.patch.dict(os.environ, {"BAZELISK_BASE_URL": base_url}):
+                self.assertEqual(
+                    bazelisk.determine_url("5.0.0rc1", False, "bazel"),
+                    base_url + "/5.0.0/bazel",
+                )
+
+
+class ParseReleasesJsonTest(unittest.TestCase):
+    def test_matches_json_parser(self):
+        with open(RELEASES_FOR_TESTS, "rb") as f:
+            body = f.read()
+        self.assertEqual(
+            bazelisk.parse_releases_json(body), bazelisk.slim_releases_json(json.loads(body))
+        )
+
+    def test_unexpected_field_order(self):
+        # prerelease before tag_name defeats the scan, so the JSON parser is used.
+        body = json.dumps(
+            [
+                {"prerelease": False, "tag_name": "5.0.0"},
+                {"prerelease": True, "tag_name": "5.1.0rc1"},
+            ]
+        ).encode()
+        self.assertEqual(
+            bazelisk.parse_releases_json(body),
+            [
+                {"tag_name": "5.0.0", "prerelease": False},
+                {"tag_name": "5.1.0rc1", "prerelease": True},
+            ],
+        )
+
+    def test_no_releases(self):
+        self.assertEqual(bazelisk.parse_releases_json(b"[]"), [])
+
+    def test_not_a_list(self):
+        with self.assertRaisesRegex(Exception, "expected a list"):
+            bazelisk.parse_releases_json(b'{"message": "Bad credentials"}')
+
+
+class GetReleasesJsonTest(unittest.TestCase):
+    RELEASES = [{"tag_name": "5.0.0", "prerelease": False}]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.releases = os.path.join(self.directory, "releases.json")
+        self.etag = self.releases + ".etag"
+
+    def write_stale_cache(self, content, etag):
+        with open(self.releases, "w") as f:
+            f.write(content)
+        with open(self.etag, "w") as f:
+            f.write(etag)
+        os.utime(self.releases, (0, 0))
+
+    def get_releases_json(self, *responses):
+        """Calls get_releases_json with read_remote_file stubbed to return or
+        raise the given responses, and returns the result and the sent headers."""
+        responses = list(responses)
+        sent_headers = []
+
+        def read_remote_file(url, headers=None):
+            sent_headers.append(dict(headers))
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with mock.patch.object(bazelisk, "read_remote_file", read_remote_file):
+            result = bazelisk.get_releases_json(self.directory)
+        return result, sent_headers
+
+    def not_modified(self):
+        return HTTPError("https://api.github.com", 304, "Not Modified", {}, None)
+
+    def test_stores_etag(self):
+        body = json.dumps(self.RELEASES).encode()
+        result, sent_headers = self.get_releases_json((body, {"ETag": '"v1"'}))
+        self.assertEqual(result, self.RELEASES)
+        self.assertNotIn("If-None-Match", sent_headers[0])
+        with open(self.etag) as f:
+            self.assertEqual(f.read(), '"v1"')
+
+    def test_not_modified_refreshes_cache(self):
+        self.write_stale_cache(json.dumps(self.RELEASES), '"v1"')
+        result, sent_headers = self.get_releases_json(self.not_modified())
+        self.assertEqual(result, self.RELEASES)
+        self.assertEqual(sent_headers[0]["If-None-Match"], '"v1"')
+        self.assertTrue(bazelisk.is_fresh(os.stat(self.releases).st_mtime))
+
+    def test_response_without_etag_removes_stale_etag(self):
+        self.write_stale_cache("[]", '"v1"')
+        body = json.dumps(self.RELEASES).encode()
+        result, _ = self.get_releases_json((body, {}))
+        self.assertEqual(result, self.RELEASES)
+        self.assertFalse(os.path.exists(self.etag))
+
+    def test_not_modified_with_corrupted_cache_fetches_again(self):
+        self.write_stale_cache("[", '"v1"')
+        body = json.dumps(self.RELEASES).encode()
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            result, sent_headers = self.get_releases_json(
+                self.not_modified(), (body, {"ETag": '"v2"'})
+            )
+        self.assertIn("releases.json", stderr.getvalue())
+        self.assertEqual(result, self.RELEASES)
+        self.assertEqual(sent_headers[0]["If-None-Match"], '"v1"')
+        self.assertNotIn("If-None-Match", sent_headers[1])
+        with open(self.etag) as f:
+            self.assertEqual(f.read(), '"v2"')
+
+
+class VersionHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # A fresh releases.json is used without any network access.
+        shutil.copy(RELEASES_FOR_TESTS, os.path.join(self.directory, "releases.json"))
+        self.history_cache = os.path.join(self.directory, "releases_history.json")
+        with open(RELEASES_FOR_TESTS, "rb") as f:
+            self.all_versions = bazelisk.order_releases(json.loads(f.read()))
+
+    def get_version_history(self, limit=None):
+        return bazelisk.get_version_history(self.directory, limit)
+
+    def read_history_cache(self):
+        with open(self.history_cache, "rb") as f:
+            return json.loads(f.read())
+
+    def expect_cache_hit(self):
+        return mock.patch.object(
+            bazelisk, "order_releases", side_effect=AssertionError("cache not used")
+        )
+
+    def test_limited_history_is_cached_as_incomplete(self):
+        self.assertEqual(self.get_version_history(2), self.all_versions[:2])
+        cached = self.read_history_cache()
+        self.assertFalse(cached["complete"])
+        self.assertEqual(cached["history"], self.all_versions[:2])
+
+    def test_shorter_limit_reuses_cache(self):
+        self.get_version_history(4)  # latest-3
+        with self.expect_cache_hit():
+            self.assertEqual(self.get_version_history(1), self.all_versions[:1])  # latest
+
+    def test_longer_limit_refreshes_incomplete_cache(self):
+        self.get_version_history(1)
+        self.assertEqual(self.get_version_history(4), self.all_versions[:4])
+        self.assertEqual(self.read_history_cache()["history"], self.all_versions[:4])
+
+    def test_complete_history_is_reused_for_any_limit(self):
+        self.assertEqual(self.get_version_history(), self.all_versions)
+        self.assertTrue(self.read_history_cache()["complete"])
+        with self.expect_cache_hit():
+            self.assertEqual(self.get_version_history(), self.all_versions)
+            self.assertEqual(self.get_version_history(3), self.all_versions[:3])
+
+    def test_cache_of_other_releases_json_is_ignored(self):
+        self.get_version_history()
+        cached = self.read_history_cache()
+        cached["releases_mtime"] -= 10
+        cached["history"] = ["0.1.0"]
+        with open(self.history_cache, "w") as f:
+            json.dump(cached, f)
+        self.assertEqual(self.get_version_history(), self.all_versions)
+
+    def test_corrupted_cache_warns_on_stderr(self):
+        with open(self.history_cache, "w") as f:
+            f.write("{")
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            self.assertEqual(self.get_version_history(), self.all_versions)
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertIn("releases_history.json", stderr.getvalue())
+
+
+class WriteFileAtomicallyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "releases.json")
+
+    def test_replaces_file(self):
+        bazelisk.write_file_atomically(self.path, b"old")
+        bazelisk.write_file_atomically(self.path, b"new")
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertEqual(os.listdir(self.directory), ["releases.json"])
+
+    @unittest.skipIf(os.name == "nt", "Windows has no POSIX permissions")
+    def test_respects_umask(self):
+        umask = os.umask(0o022)
+        os.umask(umask)
+        bazelisk.write_file_atomically(self.path, b"data")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o666 & ~umask)
+
+    def test_failure_leaves_no_temp_file(self):
+        os.mkdir(self.path)
+        with self.assertRaises(OSError):
+            bazelisk.write_file_atomically(self.path, b"data")
+        self.assertEqual(os.listdir(self.directory), ["releases.json"])
+
+
+class WorkspaceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.workspace = os.path.join(self.directory, "WORKSPACE")
+
+    def test_workspace_file(self):
+        open(self.workspace, "w").close()
+        self.assertTrue(bazelisk.has_workspace_file(self.directory))
+
+    def test_no_workspace_file(self):
+        self.assertFalse(bazelisk.has_workspace_file(self.directory))
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "requires symlinks")
+    def test_workspace_symlink(self):
+        target = os.path.join(self.directory, "WORKSPACE.real")
+        open(target, "w").close()
+        os.symlink(target, self.workspace)
+        self.assertTrue(bazelisk.has_workspace_file(self.directory))
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "requires symlinks")
+    def test_dangling_workspace_symlink(self):
+        os.symlink(os.path.join(self.directory, "missing"), self.workspace)
+        self.assertFalse(bazelisk.has_workspace_file(self.directory))
+
+
+if __name__ == "__main__":
+    unittest.main()